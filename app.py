@@ -1,37 +1,355 @@
 # app.py
-from flask import Flask, jsonify, abort, send_file
+from flask import Flask, abort, current_app, request, send_file
+import logging
 import os
+import queue
+import re
+import threading
+import time
+import orjson
+from flask_compress import Compress
+from concurrent.futures import Future
+from functools import lru_cache
 from sqlalchemy import create_engine, text
-from sqlalchemy.engine import URL
-from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import URL, make_url
+from sqlalchemy.exc import OperationalError, SQLAlchemyError
+
+logger = logging.getLogger(__name__)
 
 _engine = None
+_engine_lock = threading.Lock()
+_coords_srid = 4326  # create_db.py 的預設值；啟動時會以實際欄位定義覆寫
+_has_term_studies = True  # 啟動時確認 ns.term_studies 是否存在；不存在時改用反連接查詢
 
-def get_engine():
+def _detect_coords_srid(engine):
     """
-    Initializes and returns a global SQLAlchemy engine instance.
-    Reads database URL from environment variables.
+    Reads the SRID declared on ns.coordinates.geom so query points match it.
+    """
+    global _coords_srid
+    try:
+        with engine.connect() as conn:
+            srid = conn.execute(text("SELECT Find_SRID('ns', 'coordinates', 'geom')")).scalar()
+    except SQLAlchemyError:
+        logger.exception("Detecting the SRID of ns.coordinates.geom failed; using %s", _coords_srid)
+        return
+    if srid is not None:
+        _coords_srid = int(srid)
+
+def _detect_term_studies(engine):
+    """
+    Checks whether ns.term_studies exists; term dissociation falls back to an
+    anti-join over ns.annotations_terms when it does not.
+    """
+    global _has_term_studies
+    try:
+        with engine.connect() as conn:
+            found = conn.execute(text("SELECT to_regclass('ns.term_studies')")).scalar() is not None
+    except SQLAlchemyError:
+        logger.exception("Checking for ns.term_studies failed; using the annotations_terms anti-join")
+        found = False
+    if not found:
+        logger.warning("ns.term_studies is missing; run create_db.py --derived-only to build it. "
+                       "Falling back to the slower annotations_terms anti-join.")
+    _has_term_studies = found
+
+def _build_engine():
+    """
+    Creates the SQLAlchemy engine from DB_URL and runs the one-time startup setup.
     """
-    global _engine
-    if _engine is not None:
-        return _engine
     db_url = os.getenv("DB_URL")
     if not db_url:
         raise RuntimeError("Missing DB_URL (or DATABASE_URL) environment variable.")
     if db_url.startswith("postgres://"):
         db_url = "postgresql://" + db_url[len("postgres://"):]
-    _engine = create_engine(
+    # 使用 psycopg (v3) driver，讓伺服器端 prepared statement 可以被重複使用
+    if db_url.startswith("postgresql://"):
+        db_url = "postgresql+psycopg://" + db_url[len("postgresql://"):]
+    connect_args = {
+        "keepalives": 1,
+        "keepalives_idle": 30,
+        "keepalives_interval": 10,
+        "keepalives_count": 3,
+        # statement_timeout：避免慢查詢長時間佔用連線池中的連線
+        # search_path：於連線建立時設定，不必每個 request 都送 SET
+        "options": "-c statement_timeout=5000 -c search_path=ns,public",
+    }
+    if make_url(db_url).get_driver_name() == "psycopg":
+        # 第一次執行後即在伺服器端 PREPARE，之後重複使用查詢計畫（psycopg2 不支援此參數）
+        connect_args["prepare_threshold"] = 1
+    engine = create_engine(
         db_url,
-        pool_pre_ping=True,
+        pool_size=10,
+        max_overflow=20,
+        pool_timeout=5,
+        pool_recycle=600,
+        # 預設不做 pre-ping（每次取用連線都多一次 SELECT 1）；改靠 recycle + TCP keepalive
+        pool_pre_ping=os.getenv("DB_POOL_PRE_PING", "").lower() in ("1", "true", "yes"),
+        connect_args=connect_args,
     )
+
+    _detect_coords_srid(engine)
+    _detect_term_studies(engine)
+    return engine
+
+def get_engine():
+    """
+    Initializes and returns a global SQLAlchemy engine instance.
+    Reads database URL from environment variables.
+    """
+    global _engine
+    if _engine is not None:
+        return _engine
+    # 多執行緒 worker 下只允許一個執行緒初始化；setup（含 SRID 偵測）完成後才公開 _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = _build_engine()
     return _engine
 
+# --- SQL 語句（模組層級只建立一次） ---
+
+# 直接查 term_studies 預先聚合好的陣列：兩次索引查詢加一次陣列差集
+_SQL_DISSOC_TERMS = text("""
+    SELECT COALESCE((
+        SELECT ARRAY(SELECT unnest(a.studies) EXCEPT SELECT unnest(b.studies) ORDER BY 1)
+        FROM ns.term_studies a
+        LEFT JOIN ns.term_studies b ON b.term = :term_b
+        WHERE a.term = :term_a
+    ), '{}'::text[]);
+""")
+
+# term_studies 不存在時（舊資料庫且無 CREATE 權限）的備援：NOT EXISTS 反連接
+_SQL_DISSOC_TERMS_ANTIJOIN = text("""
+    SELECT COALESCE(array_agg(study_id ORDER BY study_id), '{}'::text[]) FROM (
+        SELECT DISTINCT a.study_id FROM ns.annotations_terms a
+        WHERE a.term = :term_a
+          AND NOT EXISTS (
+              SELECT 1 FROM ns.annotations_terms b
+              WHERE b.term = :term_b AND b.study_id = a.study_id
+          )
+    ) q;
+""")
+
+# 查詢點只在 CTE 中建立一次；SRID 以參數傳入，於啟動時由 geom 欄位讀出
+_SQL_DISSOC_LOC = text("""
+    WITH pa AS (SELECT ST_SetSRID(ST_MakePoint(:x_a, :y_a, :z_a), CAST(:srid AS integer)) AS g),
+         pb AS (SELECT ST_SetSRID(ST_MakePoint(:x_b, :y_b, :z_b), CAST(:srid AS integer)) AS g)
+    SELECT COALESCE(array_agg(study_id ORDER BY study_id), '{}'::text[]) FROM (
+        SELECT DISTINCT c.study_id FROM ns.coordinates c, pa
+        WHERE ST_DWithin(c.geom, pa.g, :radius)
+        EXCEPT
+        SELECT DISTINCT c.study_id FROM ns.coordinates c, pb
+        WHERE ST_DWithin(c.geom, pb.g, :radius)
+    ) q;
+""")
+
+# 多取一筆用來判斷結果是否被截斷
+FIND_TERMS_LIMIT = 500
+
+_SQL_FIND_TERMS = text(f"""
+    SELECT DISTINCT term FROM ns.annotations_terms
+    WHERE term ILIKE :pattern
+    ORDER BY term
+    LIMIT {FIND_TERMS_LIMIT + 1};
+""")
+
+# pg_class.reltuples 是 planner 的估計值；從未 ANALYZE 的表為 -1，此時回傳 NULL
+_SQL_TEST_DB = """
+    SELECT version(),
+           (SELECT NULLIF(reltuples, -1)::bigint FROM pg_class WHERE oid = 'ns.coordinates'::regclass),
+           (SELECT NULLIF(reltuples, -1)::bigint FROM pg_class WHERE oid = 'ns.metadata'::regclass),
+           (SELECT NULLIF(reltuples, -1)::bigint FROM pg_class WHERE oid = 'ns.annotations_terms'::regclass)
+"""
+
+# --- 將同時進來的 term 查詢合併成一次資料庫往返 (micro-batching) ---
+
+class BatchCollector:
+    """
+    Collects (term_a, term_b) dissociation requests over a short tumbling window
+    and answers all of them with a single VALUES query over ns.term_studies
+    (or over ns.annotations_terms when the view is missing).
+    """
+
+    def __init__(self, window=0.005, max_items=32):
+        self.window = window
+        self.max_items = max_items
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, term_a, term_b):
+        """
+        Queues one pair and returns a Future resolving to a tuple of study_ids.
+        """
+        # 背景執行緒延遲到第一次使用才啟動（gunicorn fork 之後才會存在）
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="term-batcher", daemon=True)
+                self._thread.start()
+        fut = Future()
+        self._queue.put((term_a, term_b, fut))
+        return fut
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_items:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._execute(batch)
+
+    def _execute(self, batch):
+        try:
+            with get_engine().connect() as conn:
+                if len(batch) == 1:
+                    # 單筆時沿用已 PREPARE 的語句
+                    term_a, term_b, _ = batch[0]
+                    sql = _SQL_DISSOC_TERMS if _has_term_studies else _SQL_DISSOC_TERMS_ANTIJOIN
+                    rows = [(0, conn.execute(sql, {"term_a": term_a, "term_b": term_b}).scalar())]
+                else:
+                    values = []
+                    params = {}
+                    for i, (term_a, term_b, _) in enumerate(batch):
+                        values.append(f"({i}, CAST(:a{i} AS text), CAST(:b{i} AS text))")
+                        params[f"a{i}"] = term_a
+                        params[f"b{i}"] = term_b
+                    if _has_term_studies:
+                        sql = text(f"""
+                            WITH pairs(i, a, b) AS (VALUES {", ".join(values)})
+                            SELECT p.i, ARRAY(SELECT unnest(a.studies) EXCEPT SELECT unnest(b.studies) ORDER BY 1)
+                            FROM pairs p
+                            JOIN ns.term_studies a ON a.term = p.a
+                            LEFT JOIN ns.term_studies b ON b.term = p.b;
+                        """)
+                    else:
+                        sql = text(f"""
+                            WITH pairs(i, a, b) AS (VALUES {", ".join(values)})
+                            SELECT p.i, array_agg(DISTINCT t.study_id ORDER BY t.study_id)
+                            FROM pairs p
+                            JOIN ns.annotations_terms t ON t.term = p.a
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM ns.annotations_terms x
+                                WHERE x.term = p.b AND x.study_id = t.study_id
+                            )
+                            GROUP BY p.i;
+                        """)
+                    rows = conn.execute(sql, params).all()
+        except Exception as e:
+            for _, _, fut in batch:
+                fut.set_exception(e)
+            return
+        # term_a 不存在（或沒有結果）的 pair 不會出現在輸出中
+        results = [()] * len(batch)
+        for i, studies in rows:
+            results[i] = studies
+        for (_, _, fut), studies in zip(batch, results):
+            fut.set_result(tuple(studies))
+
+_terms_batcher = BatchCollector()
+
+# --- 查詢結果快取 ---
+# NeuroSynth 資料是靜態的，結果只在重新啟動 app 時失效
+
+CACHE_CONTROL = "public, max-age=3600"
+
+# 每個項目最多約 14k 個 PMID 字串（約 1 MB）；最壞情況每個 worker 每個快取約 128 MB
+RESULT_CACHE_SIZE = 128
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def _studies_term_a_not_b(full_term_a, full_term_b):
+    """
+    Returns a tuple of study_ids annotated with full_term_a but not full_term_b.
+    """
+    return _terms_batcher.submit(full_term_a, full_term_b).result()
+
+@lru_cache(maxsize=RESULT_CACHE_SIZE)
+def _studies_location_a_not_b(coords_a, coords_b, radius):
+    """
+    Returns a tuple of study_ids with a peak within radius of coords_a but none near coords_b.
+    """
+    engine = get_engine()  # 第一次呼叫時才會偵測 _coords_srid
+    x_a, y_a, z_a = coords_a
+    x_b, y_b, z_b = coords_b
+    params = {
+        "x_a": x_a, "y_a": y_a, "z_a": z_a,
+        "x_b": x_b, "y_b": y_b, "z_b": z_b,
+        "radius": radius,
+        "srid": _coords_srid
+    }
+    with engine.connect() as conn:
+        return tuple(conn.execute(_SQL_DISSOC_LOC, params).scalar())
+
+# --- 合併同時進行的相同查詢 (single-flight) ---
+
+_inflight: dict[tuple, Future] = {}
+_inflight_lock = threading.Lock()
+
+def _single_flight(key, fn, *args):
+    """
+    Runs fn(*args) once per key at a time; concurrent callers with the same key
+    wait for and share that result instead of issuing their own query.
+    """
+    with _inflight_lock:
+        fut = _inflight.get(key)
+        leader = fut is None
+        if leader:
+            fut = _inflight[key] = Future()
+    if not leader:
+        return fut.result()
+    try:
+        fut.set_result(fn(*args))
+    except BaseException as e:
+        fut.set_exception(e)
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+    return fut.result()
+
+def json_response(payload, status=200):
+    """
+    Serializes payload with orjson (much faster than flask.jsonify for long study lists).
+    """
+    return current_app.response_class(orjson.dumps(payload), status=status, mimetype="application/json")
+
+# 座標格式：x_y_z，三個（可為負的）整數
+_COORD_RE = re.compile(r"-?\d+_-?\d+_-?\d+", re.ASCII)
+
+# 分頁：結果已排序並快取，分頁只是對快取的 tuple 做切片
+DEFAULT_PAGE_LIMIT = 500
+
+def _page_args():
+    """
+    Reads ?limit=&offset= from the query string, aborting with 400 unless each is a non-negative integer.
+    """
+    values = []
+    for name, default in (("limit", DEFAULT_PAGE_LIMIT), ("offset", 0)):
+        raw = request.args.get(name)
+        if raw is None:
+            values.append(default)
+        elif raw.isascii() and raw.isdigit():
+            values.append(int(raw))
+        else:
+            abort(400, description=f"{name} must be a non-negative integer.")
+    return tuple(values)
+
 def create_app():
     """
     Flask application factory.
     """
     app = Flask(__name__)
 
+    # study 清單是大量短字串，gzip 後可縮小數倍
+    app.config["COMPRESS_MIMETYPES"] = ["application/json"]
+    app.config["COMPRESS_ALGORITHM"] = "gzip"
+    app.config["COMPRESS_LEVEL"] = 5
+    app.config["COMPRESS_MIN_SIZE"] = 500
+    Compress(app)
+
     @app.get("/", endpoint="health")
     def health():
         return "<p>Server working!</p>"
@@ -56,28 +374,29 @@ def create_app():
         # 例如：'abuse' -> 'terms_abstract_tfidf__abuse'
         full_term_a = f"{PREFIX}{term_a.replace('_', ' ')}"
         full_term_b = f"{PREFIX}{term_b.replace('_', ' ')}"
-
-        sql = text("""
-            SELECT DISTINCT study_id FROM ns.annotations_terms WHERE term = :term_a
-            EXCEPT
-            SELECT DISTINCT study_id FROM ns.annotations_terms WHERE term = :term_b;
-        """)
+        limit, offset = _page_args()
 
         try:
-            with get_engine().connect() as conn:
-                # 使用處理過後的完整術語進行查詢
-                result = conn.execute(sql, {"term_a": full_term_a, "term_b": full_term_b}).fetchall()
-                studies = [row[0] for row in result]
-                return jsonify({
-                    "term_a_not_b": {
-                        "term_a": term_a, # 回傳給使用者時，仍然是簡潔的原始輸入
-                        "term_b": term_b,
-                        "count": len(studies),
-                        "studies": studies
-                    }
-                })
+            studies = _single_flight(
+                ("terms", full_term_a, full_term_b),
+                _studies_term_a_not_b, full_term_a, full_term_b,
+            )
+            page = studies[offset:offset + limit]
+            resp = json_response({
+                "term_a_not_b": {
+                    "term_a": term_a, # 回傳給使用者時，仍然是簡潔的原始輸入
+                    "term_b": term_b,
+                    "count": len(studies),
+                    "limit": limit,
+                    "offset": offset,
+                    "page_count": len(page),
+                    "studies": page
+                }
+            })
+            resp.headers["Cache-Control"] = CACHE_CONTROL
+            return resp
         except Exception as e:
-            return jsonify({"error": f"Database query failed: {e}"}), 500
+            return json_response({"error": f"Database query failed: {e}"}, 500)
 
 
     @app.get("/dissociate/locations/<coords_a>/<coords_b>", endpoint="dissociate_locations")
@@ -86,42 +405,34 @@ def create_app():
         Returns studies with activations near coords_a but not near coords_b.
         A search radius of 10mm is used for matching coordinates.
         """
-        try:
-            x_a, y_a, z_a = map(int, coords_a.split("_"))
-            x_b, y_b, z_b = map(int, coords_b.split("_"))
-        except ValueError:
+        if not (_COORD_RE.fullmatch(coords_a) and _COORD_RE.fullmatch(coords_b)):
             abort(400, description="Invalid coordinate format. Expected x_y_z.")
+        x_a, y_a, z_a = map(int, coords_a.split("_"))
+        x_b, y_b, z_b = map(int, coords_b.split("_"))
 
-        # 使用 ST_SetSRID 將即時建立的點的 SRID 設為 4326，以匹配 'geom' 欄位
-        sql = text("""
-            SELECT DISTINCT study_id FROM ns.coordinates
-            WHERE ST_DWithin(geom, ST_SetSRID(ST_MakePoint(:x_a, :y_a, :z_a), 4326), :radius)
-            EXCEPT
-            SELECT DISTINCT study_id FROM ns.coordinates
-            WHERE ST_DWithin(geom, ST_SetSRID(ST_MakePoint(:x_b, :y_b, :z_b), 4326), :radius);
-        """)
-
-        params = {
-            "x_a": x_a, "y_a": y_a, "z_a": z_a,
-            "x_b": x_b, "y_b": y_b, "z_b": z_b,
-            "radius": 10
-        }
+        radius = 10
+        limit, offset = _page_args()
 
         try:
-            with get_engine().connect() as conn:
-                result = conn.execute(sql, params).fetchall()
-                studies = [row[0] for row in result]
-                return jsonify({
-                    "location_a_not_b": {
-                        "location_a": f"{x_a}_{y_a}_{z_a}",
-                        "location_b": f"{x_b}_{y_b}_{z_b}",
-                        "radius_mm": params["radius"],
-                        "count": len(studies),
-                        "studies": studies
-                    }
-                })
+            coords = ((x_a, y_a, z_a), (x_b, y_b, z_b), radius)
+            studies = _single_flight(("locations",) + coords, _studies_location_a_not_b, *coords)
+            page = studies[offset:offset + limit]
+            resp = json_response({
+                "location_a_not_b": {
+                    "location_a": f"{x_a}_{y_a}_{z_a}",
+                    "location_b": f"{x_b}_{y_b}_{z_b}",
+                    "radius_mm": radius,
+                    "count": len(studies),
+                    "limit": limit,
+                    "offset": offset,
+                    "page_count": len(page),
+                    "studies": page
+                }
+            })
+            resp.headers["Cache-Control"] = CACHE_CONTROL
+            return resp
         except Exception as e:
-            return jsonify({"error": f"Database query failed: {e}"}), 500
+            return json_response({"error": f"Database query failed: {e}"}, 500)
 
     # --- 輔助與測試工具 ---
 
@@ -132,19 +443,21 @@ def create_app():
         用法: /find_terms/memory 或 /find_terms/abuse
         """
         # 我們搜尋原始的 term，包含前綴
-        sql = text("SELECT DISTINCT term FROM ns.annotations_terms WHERE term ILIKE :pattern ORDER BY term;")
         try:
             with get_engine().connect() as conn:
                 pattern = f"%{keyword}%"
-                result = conn.execute(sql, {"pattern": pattern}).fetchall()
-                terms = [row[0] for row in result]
-                return jsonify({
+                terms = conn.execute(_SQL_FIND_TERMS, {"pattern": pattern}).scalars().all()
+                truncated = len(terms) > FIND_TERMS_LIMIT
+                terms = terms[:FIND_TERMS_LIMIT]
+                return json_response({
                     "keyword": keyword,
                     "match_count": len(terms),
+                    "limit": FIND_TERMS_LIMIT,
+                    "truncated": truncated,
                     "matching_terms": terms
                 })
         except Exception as e:
-            return jsonify({"error": f"Database query failed: {e}"}), 500
+            return json_response({"error": f"Database query failed: {e}"}, 500)
 
     @app.get("/test_db", endpoint="test_db")
     def test_db():
@@ -155,16 +468,15 @@ def create_app():
         payload = {"ok": False, "dialect": eng.dialect.name}
         try:
             with eng.begin() as conn:
-                conn.execute(text("SET search_path TO ns, public;"))
-                payload["version"] = conn.exec_driver_sql("SELECT version()").scalar()
-                payload["coordinates_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.coordinates")).scalar()
-                payload["metadata_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.metadata")).scalar()
-                payload["annotations_terms_count"] = conn.execute(text("SELECT COUNT(*) FROM ns.annotations_terms")).scalar()
+                # 一次往返取得所有資訊；筆數是 pg_class.reltuples 估計值（O(1)，ANALYZE 後更新）
+                row = conn.exec_driver_sql(_SQL_TEST_DB).one()
+                (payload["version"], payload["coordinates_estimate"],
+                 payload["metadata_estimate"], payload["annotations_terms_estimate"]) = row
                 payload["ok"] = True
-                return jsonify(payload), 200
+                return json_response(payload, 200)
         except Exception as e:
             payload["error"] = str(e)
-            return jsonify(payload), 500
+            return json_response(payload, 500)
 
     return app
 
@@ -3,9 +3,11 @@
 
 """
 PostgreSQL loader (accelerated) with:
-- PostGIS POINTZ geometry (+ GIST) for coordinates
+- PostGIS POINTZ geometry (+ SP-GiST) for coordinates
 - FTS (tsvector) + trigger (+ GIN) for metadata
 - Fast annotations_terms via NumPy + COPY
+- term_studies materialized view (term -> study_id array)
+- --derived-only: rebuild just the API's indexes/view on an existing database
 - Optional annotations_json aggregation (+ GIN) via --enable-json
 
 Default schema: ns
@@ -36,6 +38,8 @@ def parse_args():
     ap.add_argument("--stage-chunksize", type=int, default=50000, help="pandas.to_sql() chunksize for staging loads")
     ap.add_argument("--enable-json", action="store_true", help="Also build annotations_json (slow)")
     ap.add_argument("--srid", type=int, default=4326, help="SRID for geometry(POINTZ). Default 4326")
+    ap.add_argument("--derived-only", action="store_true",
+                    help="Skip loading; only (re)build the API's indexes and term_studies view on existing tables")
     return ap.parse_args()
 
 
@@ -67,7 +71,46 @@ def is_finite_series(s: pd.Series) -> pd.Series:
 
 
 # -----------------------------
-# Coordinates (POINTZ + GIST)
+# Derived objects used by the API (also rebuilt by --derived-only)
+# -----------------------------
+def create_coordinates_spgist(conn, schema: str):
+    # SP-GiST is smaller and faster than GiST for heavily overlapping points (ST_DWithin lookups)
+    conn.execute(text(f"DROP INDEX IF EXISTS {schema}.idx_coordinates_geom_gist;"))
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_coords_geom_spgist ON {schema}.coordinates USING SPGIST (geom);"))
+
+
+def create_terms_trgm(conn, schema: str):
+    # Trigram GIN index so the API's substring ILIKE term search can use an index
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_trgm ON {schema}.annotations_terms USING GIN (term gin_trgm_ops);"))
+
+
+def create_term_studies(conn, schema: str):
+    # Precomputed term -> sorted study_id array (used by the dissociation API)
+    conn.execute(text(f"DROP MATERIALIZED VIEW IF EXISTS {schema}.term_studies;"))
+    conn.execute(text(f"""
+        CREATE MATERIALIZED VIEW {schema}.term_studies AS
+        SELECT term, array_agg(DISTINCT study_id ORDER BY study_id) AS studies
+        FROM {schema}.annotations_terms
+        GROUP BY term;
+    """))
+    conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_term_studies_term ON {schema}.term_studies (term);"))
+
+
+def build_derived(engine: Engine, schema: str):
+    """Build the API's indexes and term_studies view on already-loaded tables."""
+    with engine.begin() as conn:
+        print("→ derived: SP-GiST index on coordinates")
+        create_coordinates_spgist(conn, schema)
+        conn.execute(text(f"ANALYZE {schema}.coordinates;"))
+        print("→ derived: trigram index on annotations_terms")
+        create_terms_trgm(conn, schema)
+        print("→ derived: term_studies materialized view")
+        create_term_studies(conn, schema)
+    print("→ derived objects done.")
+
+
+# -----------------------------
+# Coordinates (POINTZ + SP-GiST)
 # -----------------------------
 def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize: int, if_exists: str, srid: int):
     print("→ coordinates: preparing dataframe")
@@ -120,10 +163,10 @@ def build_coordinates(engine: Engine, df: pd.DataFrame, schema: str, chunksize:
         """))
         print("→ coordinates: indexing & analyze")
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_study ON {schema}.coordinates (study_id);"))
-        conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_coordinates_geom_gist ON {schema}.coordinates USING GIST (geom);"))
+        create_coordinates_spgist(conn, schema)
         conn.execute(text(f"ANALYZE {schema}.coordinates;"))
         conn.execute(text(f"DROP TABLE IF EXISTS {schema}.coordinates_stage;"))
-    print("→ coordinates (POINTZ + GIST) done.")
+    print("→ coordinates (POINTZ + SP-GiST) done.")
 
 
 # -----------------------------
@@ -261,11 +304,15 @@ def build_annotations(engine: Engine, df: pd.DataFrame, schema: str, batch_cols:
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term ON {schema}.annotations_terms (term);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_study ON {schema}.annotations_terms (study_id);"))
         conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_annotations_terms_term_study ON {schema}.annotations_terms (term, study_id);"))
+        create_terms_trgm(conn, schema)
         conn.execute(text(f"ANALYZE {schema}.annotations_terms;"))
         # Build PK/unique AFTER load to avoid per-row maintenance
         conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS ux_annotations_terms ON {schema}.annotations_terms (study_id, contrast_id, term);"))
         conn.execute(text(f"ALTER TABLE {schema}.annotations_terms ADD CONSTRAINT pk_annotations_terms PRIMARY KEY USING INDEX ux_annotations_terms;"))
 
+        print("→ annotations: building term_studies materialized view")
+        create_term_studies(conn, schema)
+
         if enable_json:
             print("→ annotations_json: aggregating (this may take a while)")
             conn.execute(text("SET LOCAL work_mem = '512MB';"))
@@ -306,6 +353,11 @@ def main():
     print("✅ current_database:", db[0])
     print("✅ current_schema:", sch[0])
 
+    if args.derived_only:
+        print("\n=== Build: derived objects only ===")
+        build_derived(engine, args.schema)
+        return
+
     # Load Parquet files
     print("📦 loading Parquet files...")
     coords = load_parquet(os.path.join(args.data_dir, "coordinates.parquet"))
@@ -324,9 +376,10 @@ def main():
     build_annotations(engine, ann, args.schema, args.batch_cols, enable_json=args.enable_json)
 
     print("\n=== Ready ===")
-    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + GIST)")
+    print(f"- coordinates  : {args.schema}.coordinates (geometry(POINTZ,{args.srid}) + SP-GiST)")
     print(f"- metadata     : {args.schema}.metadata (FTS + trigger + GIN)")
     print(f"- annotations  : {args.schema}.annotations_terms (sparse via COPY)" + (" + annotations_json (GIN)" if args.enable_json else ""))
+    print(f"- term_studies : {args.schema}.term_studies (materialized view)")
 
 
 if __name__ == "__main__":
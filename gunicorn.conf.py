@@ -0,0 +1,12 @@
+# gunicorn.conf.py
+# Gunicorn 會自動讀取工作目錄下的這個檔案。
+# 所有端點都在等待 PostgreSQL，使用 gthread worker 讓同一個 worker 內的
+# 多個 request 可以同時等待 I/O（也讓 single-flight 與批次查詢有機會合併請求）。
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8000')}"
+worker_class = "gthread"
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+# 每個 worker 的執行緒數不超過 engine 連線池上限 (pool_size + max_overflow = 30)
+threads = int(os.getenv("GUNICORN_THREADS", "16"))
+timeout = 30
@@ -0,0 +1,269 @@
+# test_app.py
+# 不需要資料庫：以假的 engine / connection 取代 get_engine()
+import threading
+import time
+
+import pytest
+from werkzeug.exceptions import BadRequest
+
+import app as app_module
+
+
+class FakeResult:
+    def __init__(self, rows):
+        self._rows = rows
+
+    def scalar(self):
+        return self._rows[0][0] if self._rows else None
+
+    def all(self):
+        return list(self._rows)
+
+    def one(self):
+        row, = self._rows
+        return row
+
+    def scalars(self):
+        return FakeScalars([row[0] for row in self._rows])
+
+
+class FakeScalars:
+    def __init__(self, values):
+        self._values = values
+
+    def all(self):
+        return list(self._values)
+
+
+class FakeConnection:
+    def __init__(self, engine):
+        self.engine = engine
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def execute(self, sql, params=None):
+        self.engine.calls.append((str(sql), params))
+        if self.engine.error is not None:
+            raise self.engine.error
+        return FakeResult(self.engine.rows)
+
+    def exec_driver_sql(self, sql):
+        return self.execute(sql)
+
+
+class FakeEngine:
+    def __init__(self, rows=(), error=None):
+        self.rows = list(rows)
+        self.error = error
+        self.calls = []
+
+    def connect(self):
+        return FakeConnection(self)
+
+    begin = connect
+
+    class dialect:
+        name = "postgresql"
+
+
+@pytest.fixture
+def fake_engine(monkeypatch):
+    engine = FakeEngine()
+    monkeypatch.setattr(app_module, "get_engine", lambda: engine)
+    # 查詢結果有 lru_cache，每個測試都要從空的快取開始
+    app_module._studies_term_a_not_b.cache_clear()
+    app_module._studies_location_a_not_b.cache_clear()
+    return engine
+
+
+@pytest.fixture
+def client():
+    return app_module.app.test_client()
+
+
+# --- BatchCollector ---
+
+def test_batch_single_item_uses_prepared_statement(fake_engine):
+    fake_engine.rows = [(["1", "2"],)]
+    fut = app_module.Future()
+    app_module.BatchCollector()._execute([("a", "b", fut)])
+    assert fut.result() == ("1", "2")
+    (sql, params), = fake_engine.calls
+    assert sql == str(app_module._SQL_DISSOC_TERMS)
+    assert params == {"term_a": "a", "term_b": "b"}
+
+
+def test_batch_demultiplexes_rows_by_index(fake_engine):
+    # 列的順序與送出順序無關；term_a 不存在的 pair (i=1) 不會有列
+    fake_engine.rows = [(2, ["30"]), (0, ["10", "11"])]
+    futs = [app_module.Future() for _ in range(3)]
+    batch = [("a0", "b0", futs[0]), ("a1", "b1", futs[1]), ("a2", "b2", futs[2])]
+    app_module.BatchCollector()._execute(batch)
+    assert [f.result() for f in futs] == [("10", "11"), (), ("30",)]
+    (sql, params), = fake_engine.calls
+    assert "VALUES" in sql
+    assert params == {"a0": "a0", "b0": "b0", "a1": "a1", "b1": "b1", "a2": "a2", "b2": "b2"}
+
+
+def test_batch_falls_back_to_anti_join_without_term_studies(fake_engine, monkeypatch):
+    monkeypatch.setattr(app_module, "_has_term_studies", False)
+    fake_engine.rows = [(["7"],)]
+    fut = app_module.Future()
+    app_module.BatchCollector()._execute([("a", "b", fut)])
+    assert fut.result() == ("7",)
+    assert fake_engine.calls[0][0] == str(app_module._SQL_DISSOC_TERMS_ANTIJOIN)
+
+    fake_engine.calls.clear()
+    fake_engine.rows = [(1, ["8"])]
+    futs = [app_module.Future() for _ in range(2)]
+    app_module.BatchCollector()._execute([("a", "b", futs[0]), ("c", "d", futs[1])])
+    assert [f.result() for f in futs] == [(), ("8",)]
+    sql = fake_engine.calls[0][0]
+    assert "ns.annotations_terms" in sql and "term_studies" not in sql
+
+
+def test_batch_exception_reaches_every_future(fake_engine):
+    fake_engine.error = RuntimeError("boom")
+    futs = [app_module.Future() for _ in range(2)]
+    app_module.BatchCollector()._execute([("a", "b", futs[0]), ("c", "d", futs[1])])
+    for fut in futs:
+        with pytest.raises(RuntimeError, match="boom"):
+            fut.result()
+
+
+def test_batch_submit_coalesces_within_window(fake_engine):
+    fake_engine.rows = [(0, ["1"]), (1, ["2"]), (2, ["3"])]
+    collector = app_module.BatchCollector(window=0.2, max_items=32)
+    futs = [collector.submit(f"a{i}", f"b{i}") for i in range(3)]
+    assert [f.result(timeout=5) for f in futs] == [("1",), ("2",), ("3",)]
+    assert len(fake_engine.calls) == 1
+
+
+# --- _single_flight ---
+
+def test_single_flight_shares_one_call():
+    calls = []
+    started = threading.Event()
+
+    def slow(x):
+        calls.append(x)
+        started.set()
+        time.sleep(0.1)
+        return (x,)
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(app_module._single_flight(("k",), slow, 1)))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(app_module._single_flight(("k",), slow, 1)))
+                 for _ in range(4)]
+    for t in followers:
+        t.start()
+    for t in [leader] + followers:
+        t.join()
+    assert calls == [1]
+    assert results == [(1,)] * 5
+    assert ("k",) not in app_module._inflight
+
+
+def test_single_flight_propagates_and_clears_on_error():
+    def fail():
+        raise ValueError("bad")
+
+    with pytest.raises(ValueError, match="bad"):
+        app_module._single_flight(("err",), fail)
+    assert ("err",) not in app_module._inflight
+
+
+# --- _page_args ---
+
+@pytest.mark.parametrize("query, expected", [
+    ("/", (app_module.DEFAULT_PAGE_LIMIT, 0)),
+    ("/?limit=10&offset=20", (10, 20)),
+    ("/?limit=0", (0, 0)),
+])
+def test_page_args_valid(query, expected):
+    with app_module.app.test_request_context(query):
+        assert app_module._page_args() == expected
+
+
+@pytest.mark.parametrize("query", ["/?limit=abc", "/?limit=-1", "/?offset=1.5", "/?offset="])
+def test_page_args_invalid(query):
+    with app_module.app.test_request_context(query):
+        with pytest.raises(BadRequest):
+            app_module._page_args()
+
+
+@pytest.mark.parametrize("coords", ["1_2", "a_b_c", "1_2_3_4", "1.5_2_3", "1__2"])
+def test_locations_rejects_malformed_coordinates(fake_engine, client, coords):
+    resp = client.get(f"/dissociate/locations/{coords}/0_0_0")
+    assert resp.status_code == 400
+    assert fake_engine.calls == []
+
+
+def test_locations_binds_detected_srid(fake_engine, client, monkeypatch):
+    monkeypatch.setattr(app_module, "_coords_srid", 0)
+    fake_engine.rows = [([],)]
+    resp = client.get("/dissociate/locations/0_-52_26/-2_50_-6")
+    assert resp.status_code == 200
+    (sql, params), = fake_engine.calls
+    assert sql == str(app_module._SQL_DISSOC_LOC)
+    assert params == {"x_a": 0, "y_a": -52, "z_a": 26,
+                      "x_b": -2, "y_b": 50, "z_b": -6,
+                      "radius": 10, "srid": 0}
+
+
+def test_locations_returns_requested_page(fake_engine, client):
+    fake_engine.rows = [(["1", "2", "3", "4", "5"],)]
+    resp = client.get("/dissociate/locations/0_-52_26/-2_50_-6?limit=2&offset=1")
+    assert resp.status_code == 200
+    body = resp.get_json()["location_a_not_b"]
+    assert body["count"] == 5
+    assert body["page_count"] == 2
+    assert (body["limit"], body["offset"]) == (2, 1)
+    assert body["studies"] == ["2", "3"]
+
+
+def test_locations_rejects_bad_paging_args(fake_engine, client):
+    resp = client.get("/dissociate/locations/0_0_0/1_1_1?limit=abc")
+    assert resp.status_code == 400
+    assert fake_engine.calls == []
+
+
+# --- find_terms ---
+
+@pytest.mark.parametrize("n_rows, truncated", [(3, False), (app_module.FIND_TERMS_LIMIT + 1, True)])
+def test_find_terms_flags_truncation(fake_engine, client, n_rows, truncated):
+    fake_engine.rows = [(f"term {i:04d}",) for i in range(n_rows)]
+    resp = client.get("/find_terms/term")
+    assert resp.status_code == 200
+    body = resp.get_json()
+    assert body["truncated"] is truncated
+    assert body["limit"] == app_module.FIND_TERMS_LIMIT
+    assert body["match_count"] == min(n_rows, app_module.FIND_TERMS_LIMIT)
+    assert len(body["matching_terms"]) == body["match_count"]
+    sql, params = fake_engine.calls[0]
+    assert f"LIMIT {app_module.FIND_TERMS_LIMIT + 1}" in sql
+    assert params == {"pattern": "%term%"}
+
+
+# --- test_db ---
+
+def test_test_db_reports_row_estimates(fake_engine, client):
+    fake_engine.rows = [("PostgreSQL 16.2", 100, None, 300)]
+    resp = client.get("/test_db")
+    assert resp.status_code == 200
+    assert resp.get_json() == {
+        "ok": True,
+        "dialect": "postgresql",
+        "version": "PostgreSQL 16.2",
+        "coordinates_estimate": 100,
+        "metadata_estimate": None,  # 從未 ANALYZE 的表
+        "annotations_terms_estimate": 300,
+    }
+    (sql, _), = fake_engine.calls
+    assert sql == app_module._SQL_TEST_DB